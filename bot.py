@@ -1,9 +1,11 @@
 from __future__ import annotations
 import asyncio
-import csv
-import json
+import contextlib
+import logging
 import os
-from dataclasses import dataclass
+import random
+import signal
+from dataclasses import dataclass, asdict
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 from pathlib import Path
@@ -11,16 +13,26 @@ from typing import Optional, List
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, CommandObject
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from dotenv import load_dotenv
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # opcional: não existe no Windows
+    uvloop = None
 
 # --- mini servidor HTTP para "abrir porta" no Render ---
 from aiohttp import web
 
+logger = logging.getLogger(__name__)
+
 # ==========================
 # Configuração e constantes
 # ==========================
@@ -32,9 +44,17 @@ EMPREGADOS: List[str] = [
 ]
 
 STATE_FILE = Path("state.json")
+STATE_TMP_FILE = STATE_FILE.with_suffix(".json.tmp")
 LOG_FILE = Path("log.csv")
 SECRETARIA = "Secretaria"
 DEFAULT_HOLDER = SECRETARIA
+BR_TZ = ZoneInfo("America/Sao_Paulo")
+BR_FMT = "%d/%m/%Y %H:%M"
+STATE_FLUSH_DELAY = 0.2  # segundos para agrupar várias alterações numa escrita só
+STATE_RETRY_MAX_DELAY = 30  # teto (segundos) da espera entre tentativas quando a gravação falha
+PINNED_REFRESH_DELAY = 0.25  # segundos para juntar edições seguidas da mensagem fixa
+TELEGRAM_TIMEOUT = 10      # segundos por chamada à API (o long polling soma o seu próprio)
+POLLING_TIMEOUT = 30       # segundos que cada getUpdates fica aberto esperando novidades
 
 # ================
 # Estado persistido
@@ -45,22 +65,95 @@ class State:
     updated_at_iso: str = datetime.now(timezone.utc).isoformat()
     pinned_message_id: Optional[int] = None
     chat_id: Optional[int] = None
+    # horário já formatado para exibição (calculado só quando a chave muda)
+    updated_at_brazil: Optional[str] = None
+
+    # caches em memória (não são persistidos):
+    # ((holder, updated_at_iso), texto) do último status_text
+    # e (texto, teclado) exibidos na mensagem fixa.
+    # _updated_at e updated_at_brazil só ficam certos se holder e horário mudarem
+    # por update_holder(); atribuir direto em updated_at_iso deixa os dois velhos.
+    _cached_text = None
+    _pinned_render = None
+    _updated_at = None  # updated_at_iso já como datetime
 
     @classmethod
     def load(cls) -> "State":
-        if STATE_FILE.exists():
-            try:
-                data = json.loads(STATE_FILE.read_text(encoding="utf-8"))
-                return cls(**data)
-            except Exception:
-                pass
+        # se o state.json estiver ilegível, tenta a última gravação temporária
+        for path in (STATE_FILE, STATE_TMP_FILE):
+            if path.exists():
+                try:
+                    data = orjson.loads(path.read_bytes())
+                    return cls(**data)
+                except Exception:
+                    pass
         return cls()
 
+    def dumps(self) -> bytes:
+        return orjson.dumps(asdict(self), option=orjson.OPT_INDENT_2)
+
     def save(self) -> None:
-        STATE_FILE.write_text(
-            json.dumps(self.__dict__, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
+        _write_state_file(self.dumps())
+
+    @property
+    def updated_at(self) -> Optional[datetime]:
+        """updated_at_iso como datetime; None se o valor salvo for inválido."""
+        if self._updated_at is None:
+            try:
+                self._updated_at = datetime.fromisoformat(self.updated_at_iso)
+            except (TypeError, ValueError):
+                return None
+        return self._updated_at
+
+    def update_holder(self, novo: str) -> None:
+        """Único jeito suportado de trocar quem tem a chave (atualiza os caches do horário)."""
+        agora = datetime.now(timezone.utc)
+        self.current_holder = novo
+        self.updated_at_iso = agora.isoformat()
+        self._updated_at = agora
+        self.updated_at_brazil = fmt_brazil(agora)
+
+    def mark_dirty(self) -> None:
+        """Agenda a gravação; quem escreve no disco é o _state_flusher."""
+        _state_dirty.set()
+
+def _write_all(fd: int, data: bytes) -> None:
+    """os.write pode gravar só parte: repete até ir tudo (ou levanta OSError)."""
+    while data:
+        n = os.write(fd, data)
+        if n == 0:
+            raise OSError("os.write não gravou nenhum byte")
+        data = data[n:]
+
+def _write_state_file(data: bytes) -> None:
+    """Escreve num arquivo temporário e troca pelo state.json de uma vez."""
+    fd = os.open(STATE_TMP_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _write_all(fd, data)  # se falhar, o replace não roda e o state.json antigo fica
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(STATE_TMP_FILE, STATE_FILE)
+
+_state_dirty = asyncio.Event()
+
+async def _state_flusher():
+    """Grava state.json em segundo plano, juntando alterações próximas."""
+    espera = STATE_FLUSH_DELAY
+    while True:
+        await _state_dirty.wait()
+        await asyncio.sleep(espera)
+        _state_dirty.clear()
+        data = state.dumps()
+        try:
+            await asyncio.to_thread(_write_state_file, data)
+        except Exception as e:
+            # continua sujo; a próxima tentativa espera o dobro (até o teto) em vez de girar
+            espera = min(espera * 2, STATE_RETRY_MAX_DELAY)
+            logger.warning("Falha ao gravar state.json (nova tentativa em %ss): %s", espera, e)
+            _state_dirty.set()
+        else:
+            espera = STATE_FLUSH_DELAY
 
 # ==============
 # Utilitários
@@ -68,26 +161,127 @@ class State:
 def utcnow_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def fmt_brazil(dt_iso: str) -> str:
-    """Converte ISO UTC para horário de Brasília (24h)."""
+def fmt_brazil(dt: datetime) -> str:
+    """Converte datetime UTC para horário de Brasília (24h)."""
+    return dt.astimezone(BR_TZ).strftime(BR_FMT)
+
+LOG_HEADER = ["timestamp_utc", "acao", "de", "para", "by_user_id", "chat_id"]
+LOG_FLUSH_ROWS = 64      # grava a cada N linhas…
+LOG_FLUSH_INTERVAL = 0.5  # …ou a cada X segundos, o que vier primeiro
+LOG_RETRY_DELAY = 1       # segundos até tentar de novo quando a gravação falha…
+LOG_RETRY_MAX_DELAY = 30  # …dobrando a cada falha seguida, até este teto
+
+_log_queue: asyncio.Queue = asyncio.Queue()
+_log_fd: Optional[int] = None
+_csv_buf = None
+_csv_writer = None
+
+# valores que nunca precisam de aspas no CSV (sem vírgula, aspas ou quebra de linha)
+_LOG_ACOES = frozenset({"reset", "transferir"})
+_LOG_NOMES = frozenset(n for n in EMPREGADOS if not any(c in n for c in ',"\r\n'))
+
+def open_log():
+    """Abre log.csv uma única vez com O_APPEND e escreve o cabeçalho se estiver vazio."""
+    global _log_fd, _csv_buf, _csv_writer
+    import csv  # só a tarefa de log usa; não pesa na inicialização do bot
+    import io
+    _csv_buf = io.StringIO()
+    _csv_writer = csv.writer(_csv_buf)
+    # O_APPEND: cada os.write vai inteiro para o fim do arquivo, sem intercalar linhas
+    _log_fd = os.open(LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    if os.fstat(_log_fd).st_size == 0:
+        _write_all(_log_fd, format_log_rows([LOG_HEADER]))
+
+def close_log(pendente: bytes = b""):
+    """Grava o pendente e o que ainda estiver na fila e fecha o arquivo de log."""
+    global _log_fd
+    if _log_fd is None:
+        return
+    rows = []
+    while not _log_queue.empty():
+        rows.append(_log_queue.get_nowait())
+    try:
+        if pendente or rows:
+            _write_all(_log_fd, pendente + format_log_rows(rows))
+    finally:
+        os.close(_log_fd)
+        _log_fd = None
+
+def format_log_rows(rows) -> bytes:
+    """Monta as linhas CSV; com valores conhecidos, pula as checagens de aspas do csv."""
+    linhas = []
+    for row in rows:
+        ts, action, de, para, by_user_id, chat_id = row
+        if action in _LOG_ACOES and de in _LOG_NOMES and para in _LOG_NOMES:
+            linhas.append(f"{ts},{action},{de},{para},{by_user_id},{chat_id}\r\n")
+        else:
+            _csv_writer.writerow(row)
+            linhas.append(_csv_buf.getvalue())
+            _csv_buf.seek(0)
+            _csv_buf.truncate()
+    return "".join(linhas).encode("utf-8")
+
+def log_event(action: str, de: str, para: str, by_user_id: int, chat_id: int, ts: Optional[str] = None):
+    """Só enfileira: quem escreve no disco é o _log_writer_task."""
+    _log_queue.put_nowait([ts or utcnow_iso(), action, de, para, by_user_id, chat_id])
+
+async def _log_writer_task():
+    """Consome a fila de log e grava por lote (até N linhas ou X segundos)."""
+    loop = asyncio.get_running_loop()
+    open_log()
+    rows = []
+    pendente = b""  # lote formatado e ainda não gravado
     try:
-        dt = datetime.fromisoformat(dt_iso)
-        return dt.astimezone(ZoneInfo("America/Sao_Paulo")).strftime("%d/%m/%Y %H:%M")
-    except Exception:
-        return dt_iso
-
-def ensure_log_header():
-    exists = LOG_FILE.exists()
-    with LOG_FILE.open("a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        if not exists:
-            writer.writerow(["timestamp_utc", "acao", "de", "para", "by_user_id", "chat_id"])
-
-def log_event(action: str, de: str, para: str, by_user_id: int, chat_id: int):
-    ensure_log_header()
-    with LOG_FILE.open("a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([utcnow_iso(), action, de, para, by_user_id, chat_id])
+        while True:
+            rows = [await _log_queue.get()]
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while len(rows) < LOG_FLUSH_ROWS:
+                if not _log_queue.empty():
+                    rows.append(_log_queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                # asyncio.wait em vez de wait_for: no 3.11 o wait_for pode engolir
+                # um cancelamento que chega junto com o item
+                getter = asyncio.ensure_future(_log_queue.get())
+                try:
+                    await asyncio.wait((getter,), timeout=timeout)
+                finally:
+                    if getter.done():
+                        rows.append(getter.result())
+                    else:
+                        getter.cancel()
+                if not getter.done():  # prazo acabou
+                    break
+            pendente = format_log_rows(rows)
+            rows = []
+            espera = LOG_RETRY_DELAY
+            while pendente:
+                # um write só por lote; se a tarefa for cancelada no meio, ele termina antes do close_log
+                write = asyncio.ensure_future(asyncio.to_thread(_write_all, _log_fd, pendente))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    with contextlib.suppress(OSError):  # se falhar, o finally tenta mais uma vez
+                        await write
+                        pendente = b""
+                    raise
+                except OSError as e:
+                    # disco cheio, permissão etc.: não derruba o bot; guarda o lote e tenta de novo
+                    logger.warning("Falha ao gravar log.csv (nova tentativa em %ss): %s", espera, e)
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, LOG_RETRY_MAX_DELAY)
+                else:
+                    pendente = b""
+    finally:
+        # linhas tiradas da fila mas ainda não gravadas quando veio o cancelamento
+        if rows:
+            pendente += format_log_rows(rows)
+        try:
+            close_log(pendente)
+        except OSError as e:
+            logger.warning("Falha ao gravar log.csv no encerramento: %s", e)
 
 def build_main_keyboard() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
@@ -95,30 +289,60 @@ def build_main_keyboard() -> InlineKeyboardMarkup:
     kb.adjust(1)
     return kb.as_markup()
 
+# botões fixos, criados uma vez e reaproveitados por todos os teclados de transferência
+_TRANSFER_BUTTONS = tuple(
+    (nome, InlineKeyboardButton(text=nome, callback_data=f"definir::{nome}"))
+    for nome in EMPREGADOS
+)
+_VOLTAR_BUTTON = InlineKeyboardButton(text="⬅️ Voltar", callback_data="voltar")
+
 def build_transfer_keyboard(exclude: Optional[str] = None) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    for nome in EMPREGADOS:
-        if exclude and nome == exclude:
-            continue
-        kb.button(text=nome, callback_data=f"definir::{nome}")
-    kb.adjust(3)
-    kb.button(text="⬅️ Voltar", callback_data="voltar")
-    kb.adjust(3)
-    return kb.as_markup()
+    """Nomes em linhas de 3 e o "Voltar" sozinho na última linha."""
+    botoes = [botao for nome, botao in _TRANSFER_BUTTONS if not (exclude and nome == exclude)]
+    rows = [botoes[i:i + 3] for i in range(0, len(botoes), 3)]
+    rows.append([_VOLTAR_BUTTON])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# callback_data "definir::NOME" -> NOME, para filtrar e despachar com um lookup só
+_DEFINIR_MAP = {f"definir::{nome}": nome for nome in EMPREGADOS}
+_DEFINIR_KEYS = frozenset(_DEFINIR_MAP)
+
+# Teclados são estáticos (EMPREGADOS não muda em runtime): monta uma vez só.
+_MAIN_KB = build_main_keyboard()
+# a Secretaria nunca é tirada da lista: com a chave lá, vale o teclado completo
+_TRANSFER_KB_FULL = build_transfer_keyboard(None)
+_TRANSFER_KB_BY_EXCLUDE = {
+    nome: build_transfer_keyboard(nome) for nome in EMPREGADOS if nome != SECRETARIA
+}
+
+_HEADLINE_SECRETARIA = "🔑 **Chave na Secretaria**"
+_HEADLINE_COM = "🔑 **Chave com:** {holder}"
+_STATUS_SECRETARIA = _HEADLINE_SECRETARIA + "\n**Atualizado:** {atualizado}"
+_STATUS_COM = _HEADLINE_COM + "\n**Atualizado:** {atualizado}"
+
+def status_headline(state: State) -> str:
+    """Só a primeira linha do status (quem está com a chave)."""
+    if state.current_holder == SECRETARIA:
+        return _HEADLINE_SECRETARIA
+    return _HEADLINE_COM.format(holder=state.current_holder)
 
 def status_text(state: State) -> str:
     """Mensagem fixada: alterna entre 'na Secretaria' e 'com NOME'."""
-    atualizado = fmt_brazil(state.updated_at_iso)
+    # só muda quando muda quem tem a chave ou o horário, e os dois mudam juntos em
+    # update_holder(): a chave do cache invalida, e updated_at_brazil já vem certo
+    chave = (state.current_holder, state.updated_at_iso)
+    if state._cached_text is not None and state._cached_text[0] == chave:
+        return state._cached_text[1]
+    atualizado = state.updated_at_brazil
+    if atualizado is None:  # state.json antigo, sem o campo
+        dt = state.updated_at
+        atualizado = fmt_brazil(dt) if dt is not None else state.updated_at_iso
     if state.current_holder == SECRETARIA:
-        return (
-            f"🔑 **Chave na Secretaria**\n"
-            f"**Atualizado:** {atualizado}"
-        )
+        texto = _STATUS_SECRETARIA.format(atualizado=atualizado)
     else:
-        return (
-            f"🔑 **Chave com:** {state.current_holder}\n"
-            f"**Atualizado:** {atualizado}"
-        )
+        texto = _STATUS_COM.format(holder=state.current_holder, atualizado=atualizado)
+    state._cached_text = (chave, texto)
+    return texto
 
 # =====================
 # Bot & helpers
@@ -127,20 +351,111 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("Defina BOT_TOKEN nas variáveis de ambiente do Render (Environment).")
+SEND_CONFIRMATION = os.getenv("SEND_CONFIRMATION", "0") == "1"
+# opcional: servidor local do Bot API (tdlib/telegram-bot-api), ex.: http://localhost:8081
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+# sessão explícita só para apontar o servidor da API e limitar o tempo por chamada;
+# o pool de conexões fica no padrão do aiogram (100 conexões, com keep-alive)
+session = AiohttpSession(
+    api=TelegramAPIServer.from_base(BOT_API_URL, is_local=True) if BOT_API_URL else PRODUCTION,
+    timeout=TELEGRAM_TIMEOUT,
+)
 
 # aiogram 3.x: parse_mode vai via DefaultBotProperties
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
 dp = Dispatcher()
 state = State.load()
 
+def is_pinned(message: Message) -> bool:
+    """True se a mensagem é a própria mensagem fixa de status."""
+    return message.chat.id == state.chat_id and message.message_id == state.pinned_message_id
+
+def remember_pinned_markup(message: Message, kb: InlineKeyboardMarkup) -> None:
+    """Anota o teclado que ficou na mensagem fixa após editar só o reply_markup."""
+    if is_pinned(message) and state._pinned_render is not None:
+        state._pinned_render = (state._pinned_render[0], kb)
+
+async def safe_call(factory, max_retries: int = 3) -> bool:
+    """Chama a API do Telegram; True se a mensagem ficou como pedido.
+
+    Em flood control (TelegramRetryAfter) espera o tempo pedido, com um pouco de
+    jitter, e tenta de novo até max_retries vezes.
+    """
+    for tentativa in range(1, max_retries + 1):
+        try:
+            await factory()
+            return True
+        except TelegramRetryAfter as e:
+            if tentativa == max_retries:
+                logger.warning("Flood control do Telegram, desistindo após %s tentativa(s)", tentativa)
+                return False
+            logger.warning("Flood control do Telegram, aguardando %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after + random.random() * 0.5)
+        except TelegramBadRequest as e:
+            # "message is not modified": já estava assim, não é erro
+            if "message is not modified" in e.message:
+                return True
+            logger.warning("Telegram recusou a chamada: %s", e.message)
+            return False
+        except TelegramAPIError as e:
+            logger.warning("Falha na API do Telegram: %s", e)
+            return False
+    return False
+
+# erros de edição que querem dizer "a mensagem fixa não existe mais (ou não é editável)"
+_PINNED_GONE_ERRORS = ("message to edit not found", "message can't be edited", "MESSAGE_ID_INVALID")
+
+_pinned_edit_lock = asyncio.Lock()
+
+async def refresh_pinned() -> None:
+    """Atualiza a mensagem fixa com o status atual, enviando só o que mudou."""
+    # uma edição por vez: quem espera o lock vê o que a anterior já deixou lá
+    async with _pinned_edit_lock:
+        if not (state.chat_id and state.pinned_message_id):
+            return
+        texto = status_text(state)
+        renderizado = state._pinned_render
+        if renderizado == (texto, _MAIN_KB):
+            return
+        if renderizado is not None and renderizado[0] == texto:
+            ok = await safe_call(lambda: bot.edit_message_reply_markup(
+                chat_id=state.chat_id,
+                message_id=state.pinned_message_id,
+                reply_markup=_MAIN_KB,
+            ))
+        else:
+            ok = await safe_call(lambda: bot.edit_message_text(
+                chat_id=state.chat_id,
+                message_id=state.pinned_message_id,
+                text=texto,
+                reply_markup=_MAIN_KB,
+            ))
+        if ok:
+            state._pinned_render = (texto, _MAIN_KB)
+
+_pending_refresh: dict[int, asyncio.Task] = {}
+
+def schedule_pinned_refresh() -> None:
+    """Agenda a atualização da mensagem fixa; numa rajada, só o último estado é enviado."""
+    chat_id = state.chat_id
+    if not (chat_id and state.pinned_message_id):
+        return
+    pendente = _pending_refresh.get(chat_id)
+    if pendente is not None:
+        pendente.cancel()
+    _pending_refresh[chat_id] = asyncio.create_task(_refresh_pinned_after(chat_id, PINNED_REFRESH_DELAY))
+
+async def _refresh_pinned_after(chat_id: int, delay: float) -> None:
+    await asyncio.sleep(delay)
+    # daqui em diante a edição não é mais cancelada por um novo agendamento
+    _pending_refresh.pop(chat_id, None)
+    await refresh_pinned()
+
 async def safe_answer(cb: CallbackQuery, text: str = ""):
     """Responde callback imediatamente e ignora erro de expiração do Telegram."""
-    try:
-        await cb.answer(text)
-    except TelegramBadRequest:
-        pass
-    except Exception:
-        pass
+    # sem nova tentativa: a resposta do callback expira antes de o flood control passar
+    await safe_call(lambda: cb.answer(text), max_retries=1)
 
 # =====================
 # Comandos
@@ -156,60 +471,53 @@ async def cmd_setup(msg: Message):
         return
 
     text = status_text(state)
-    kb = build_main_keyboard()
+    kb = _MAIN_KB
 
-    try:
-        if state.pinned_message_id and state.chat_id == msg.chat.id:
+    sumiu = True
+    if state.pinned_message_id and state.chat_id == msg.chat.id:
+        try:
             await bot.edit_message_text(
                 chat_id=state.chat_id,
                 message_id=state.pinned_message_id,
                 text=text,
                 reply_markup=kb,
             )
-        else:
-            m = await msg.answer(text, reply_markup=kb)
-            try:
-                await bot.pin_chat_message(msg.chat.id, m.message_id, disable_notification=True)
-            except Exception:
-                pass
-            state.pinned_message_id = m.message_id
-            state.chat_id = msg.chat.id
-            state.save()
-    except Exception:
+            sumiu = False
+        except TelegramBadRequest as e:
+            if "message is not modified" in e.message:
+                sumiu = False
+            elif not any(motivo in e.message for motivo in _PINNED_GONE_ERRORS):
+                logger.warning("Telegram recusou editar a mensagem fixa: %s", e.message)
+                await msg.reply("Não consegui atualizar a mensagem fixa. Tente o /setup de novo.")
+                return
+        except TelegramAPIError as e:
+            # flood control, rede etc.: a mensagem fixa continua lá, não cria outra
+            logger.warning("Falha ao editar a mensagem fixa: %s", e)
+            await msg.reply("Telegram indisponível no momento. Tente o /setup de novo em instantes.")
+            return
+    # sem mensagem fixa neste chat (ou ela sumiu): cria e fixa uma nova
+    if sumiu:
         m = await msg.answer(text, reply_markup=kb)
-        try:
-            await bot.pin_chat_message(msg.chat.id, m.message_id, disable_notification=True)
-        except Exception:
-            pass
+        await safe_call(lambda: bot.pin_chat_message(msg.chat.id, m.message_id, disable_notification=True))
         state.pinned_message_id = m.message_id
         state.chat_id = msg.chat.id
-        state.save()
+        state.mark_dirty()
+    state._pinned_render = (text, kb)
 
     await msg.reply("Status preparado e (tentei) fixado. Use os botões para transferir.")
 
 @dp.message(Command("status"))
 async def cmd_status(msg: Message):
-    await msg.reply(status_text(state), reply_markup=build_main_keyboard())
+    await msg.reply(status_text(state), reply_markup=_MAIN_KB)
 
 @dp.message(Command("reset"))
 async def cmd_reset(msg: Message):
+    # ler-alterar-gravar sem nenhum await no meio: no loop do asyncio isso já é atômico
     anterior = state.current_holder
-    state.current_holder = SECRETARIA
-    state.updated_at_iso = utcnow_iso()
-    state.save()
-
-    if state.chat_id and state.pinned_message_id:
-        try:
-            await bot.edit_message_text(
-                chat_id=state.chat_id,
-                message_id=state.pinned_message_id,
-                text=status_text(state),
-                reply_markup=build_main_keyboard(),
-            )
-        except Exception:
-            pass
-
-    log_event("reset", anterior, SECRETARIA, msg.from_user.id, msg.chat.id)
+    state.update_holder(SECRETARIA)
+    state.mark_dirty()
+    log_event("reset", anterior, SECRETARIA, msg.from_user.id, msg.chat.id, ts=state.updated_at_iso)
+    schedule_pinned_refresh()
     await msg.reply("Status resetado para *Secretaria*.")
 
 # =====================
@@ -218,74 +526,78 @@ async def cmd_reset(msg: Message):
 @dp.callback_query(F.data == "transferir")
 async def on_transferir(cb: CallbackQuery):
     await safe_answer(cb, "Escolha para quem transferir.")
-    atual = state.current_holder
-    kb = build_transfer_keyboard(exclude=atual if atual != SECRETARIA else None)
-    try:
-        await cb.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        pass
+    kb = _TRANSFER_KB_BY_EXCLUDE.get(state.current_holder, _TRANSFER_KB_FULL)
+    if await safe_call(lambda: cb.message.edit_reply_markup(reply_markup=kb)):
+        remember_pinned_markup(cb.message, kb)
 
 @dp.callback_query(F.data == "voltar")
 async def on_voltar(cb: CallbackQuery):
     await safe_answer(cb)
-    try:
-        await cb.message.edit_reply_markup(reply_markup=build_main_keyboard())
-    except Exception:
-        pass
+    if await safe_call(lambda: cb.message.edit_reply_markup(reply_markup=_MAIN_KB)):
+        remember_pinned_markup(cb.message, _MAIN_KB)
 
-@dp.callback_query(F.data.startswith("definir::"))
+@dp.callback_query(F.data.in_(_DEFINIR_KEYS))
 async def on_definir(cb: CallbackQuery):
-    await safe_answer(cb, "Atualizando…")
-    novo = cb.data.split("::", 1)[1]
+    novo = _DEFINIR_MAP[cb.data]
+
     anterior = state.current_holder
 
-    state.current_holder = novo
-    state.updated_at_iso = utcnow_iso()
-    state.save()
+    # nada mudou: só avisa e volta o teclado principal, sem gravar nem reenviar status
+    if novo == anterior:
+        await safe_answer(cb, f"ℹ️ Chave permanece com {novo}.")
+        if await safe_call(lambda: cb.message.edit_reply_markup(reply_markup=_MAIN_KB)):
+            remember_pinned_markup(cb.message, _MAIN_KB)
+        return
 
-    if state.chat_id and state.pinned_message_id:
-        try:
-            await bot.edit_message_text(
-                chat_id=state.chat_id,
-                message_id=state.pinned_message_id,
-                text=status_text(state),
-                reply_markup=build_main_keyboard(),
-            )
-        except Exception:
-            pass
+    # ler-alterar-gravar sem nenhum await no meio: no loop do asyncio isso já é
+    # atômico em relação aos outros handlers (o state é um só para todos os chats)
+    state.update_holder(novo)
+    state.mark_dirty()
+    log_event("transferir", anterior, novo, cb.from_user.id, cb.message.chat.id, ts=state.updated_at_iso)
+    schedule_pinned_refresh()
 
-    try:
-        await cb.message.edit_text(status_text(state), reply_markup=build_main_keyboard())
-    except Exception:
-        pass
+    # confirmação via toast (não conta no limite de mensagens do grupo), enviada
+    # junto com a edição da mensagem clicada (a fixa já está agendada acima)
+    chamadas = [safe_answer(cb, "✅ Chave na Secretaria" if novo == SECRETARIA else f"✅ Chave com {novo}")]
+    if not is_pinned(cb.message):
+        chamadas.append(safe_call(lambda: cb.message.edit_text(status_text(state), reply_markup=_MAIN_KB)))
+    await asyncio.gather(*chamadas)
 
-    log_event("transferir", anterior, novo, cb.from_user.id, cb.message.chat.id)
+    # a mensagem no chat é opcional (SEND_CONFIRMATION=1)
+    if SEND_CONFIRMATION:
+        await safe_call(lambda: cb.message.answer(f"✅ Status atualizado: {status_headline(state)}"))
 
-    try:
-        resumo = status_text(state).splitlines()[0]
-        if anterior != novo:
-            await cb.message.answer(f"✅ Status atualizado: {resumo}")
-        else:
-            await cb.message.answer(f"ℹ️ Chave permanece: {resumo}")
-    except Exception:
-        pass
+@dp.callback_query(F.data.startswith("definir::"))
+async def on_definir_invalido(cb: CallbackQuery):
+    """Botão de um teclado antigo (nome que saiu de EMPREGADOS): avisa e troca o teclado."""
+    await safe_answer(cb, "Opção inválida, escolha de novo.")
+    kb = _TRANSFER_KB_BY_EXCLUDE.get(state.current_holder, _TRANSFER_KB_FULL)
+    if await safe_call(lambda: cb.message.edit_reply_markup(reply_markup=kb)):
+        remember_pinned_markup(cb.message, kb)
 
 # =====================
 # HTTP server (para Render Web Service)
 # =====================
-async def run_http_server():
-    app = web.Application()
+# corpos prontos; um web.Response não pode ser reaproveitado entre requisições
+_ROOT_BODY = "Bot da Chave — OK".encode("utf-8")
+_HEALTH_BODY = b"ok"
 
-    async def root(_):
-        return web.Response(text="Bot da Chave — OK")
+routes = web.RouteTableDef()
 
-    async def health(_):
-        return web.Response(text="ok")
+@routes.get("/")
+async def root(_):
+    return web.Response(body=_ROOT_BODY, content_type="text/plain", charset="utf-8")
 
-    app.router.add_get("/", root)
-    app.router.add_get("/health", health)
+@routes.get("/health")
+async def health(_):
+    return web.Response(body=_HEALTH_BODY, content_type="text/plain", charset="utf-8")
+
+async def run_http_server():
+    app = web.Application()
+    app.add_routes(routes)
     port = int(os.environ.get("PORT", "10000"))
-    runner = web.AppRunner(app)
+    # sem access log: o health check do Render bate a cada poucos segundos
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
@@ -297,13 +609,39 @@ async def run_http_server():
 # ============
 async def main():
     print("Bot da Chave rodando…")
+    # gravadores em segundo plano sobem antes do polling, para o log.csv
+    # já estar aberto quando chegarem os primeiros cliques
+    log_task = asyncio.create_task(_log_writer_task())
+    flush_task = asyncio.create_task(_state_flusher())
     # roda bot + http em paralelo
-    poll_task = asyncio.create_task(dp.start_polling(bot, allowed_updates=["message", "callback_query"]))
+    # handle_signals=False: SIGINT/SIGTERM ficam com o asyncio (ver _on_sigterm),
+    # para o desligamento cancelar todas as tarefas e descarregar log/estado
+    poll_task = asyncio.create_task(dp.start_polling(
+        bot,
+        allowed_updates=["message", "callback_query"],
+        polling_timeout=POLLING_TIMEOUT,
+        handle_as_tasks=True,
+        handle_signals=False,
+    ))
     http_task = asyncio.create_task(run_http_server())
-    await asyncio.gather(poll_task, http_task)
+    await asyncio.gather(log_task, flush_task, poll_task, http_task)
+
+def _on_sigterm(signum, frame):
+    # Render encerra o serviço com SIGTERM: trata como Ctrl+C para o
+    # desligamento descarregar o log e o state.json pendentes
+    raise SystemExit(0)
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _on_sigterm)
     try:
-        asyncio.run(main())
+        # uvloop acelera o loop de eventos quando está instalado
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Encerrando bot…")
+    finally:
+        # garante que a última alteração pendente vá para o disco
+        if _state_dirty.is_set():
+            state.save()